@@ -11,6 +11,7 @@ from datetime import timedelta
 from tqdm import tqdm, trange
 import matplotlib.pyplot as plt
 import argparse
+from train import build_backbone, build_model
 
 BPM = 128
 # N_FFT = 256
@@ -20,12 +21,12 @@ WIN_LEN = 60 * 4 / BPM
 song_types = ['future house', 'bass house', 'progressive house', 'melodic house']
 transform = transforms.Compose([
     transforms.Resize((96, 96)),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    transforms.PILToTensor()
 ])
 
 
-def inference(track_name, delta=WIN_LEN, window_length=WIN_LEN):
+def inference(track_name, delta=WIN_LEN, window_length=WIN_LEN, model_path='./param/finetuned_ResNet.pt',
+              backbone_id=1, network_version='legacy'):
     sound, sr = librosa.load(track_name)
     print('Sample rate: {}'.format(sr))
     spec_dir = './melspecgrams/'
@@ -34,7 +35,10 @@ def inference(track_name, delta=WIN_LEN, window_length=WIN_LEN):
     window_labels = []
     delta_frame_cnt, window_frame_cnt = int(delta * sr), int(window_length * sr)
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
-    model = torch.load('./param/finetuned_ResNet.pth').to(device)
+    # Must match the --id / --network_version the checkpoint was trained with in train.py
+    model = build_model(build_backbone(backbone_id), network_version)
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    model = model.to(device)
     model.eval()
 
     for st in tqdm(range(0, sound.shape[0], delta_frame_cnt), desc=f'inference on track {track_name}'):
@@ -158,5 +162,8 @@ if __name__ == '__main__':
     '''
     parser = argparse.ArgumentParser()
     parser.add_argument('--track_name', type=str, default='CA7AX Set #3.ogg')
+    parser.add_argument('--checkpoint', type=str, default='./param/finetuned_ResNet.pt')
+    parser.add_argument('--id', type=int, default=1) # backbone id, as in train.py
+    parser.add_argument('--network_version', type=str, default='legacy') # "legacy" or "experimental"
     args = parser.parse_args()
-    inference(args.track_name)
+    inference(args.track_name, model_path=args.checkpoint, backbone_id=args.id, network_version=args.network_version)
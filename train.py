@@ -1,5 +1,7 @@
 import random
 import os
+import sys
+import contextlib
 import json
 import numpy as np
 from PIL import Image
@@ -12,10 +14,13 @@ import matplotlib.pyplot as plt
 
 import torchvision
 from torchvision import transforms, models
+from torchvision.io import read_file, decode_jpeg, ImageReadMode
 from torch.utils.tensorboard import SummaryWriter
 import torch
 from torch import nn, optim
-from torch.utils.data import Dataset, DataLoader
+import torch.distributed as dist
+from torch.utils.data import Dataset, DataLoader, TensorDataset
+from torch.utils.data.distributed import DistributedSampler
 import argparse
 from datetime import date
 from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
@@ -32,14 +37,19 @@ torch.manual_seed(SEED)
 
 EPOCHS = 20
 LR = 2e-3
-BATCH_SIZE = 4
+BATCH_SIZE = 64
+GRAD_ACCUM_STEPS = 1
+NUM_WORKERS = (os.cpu_count() or 2) // 2
+EVAL_WORKERS = 2
 data_path = "./"
 song_types = ['future house', 'bass house', 'progressive house', 'melodic house']
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
 
-def get_tensors(transform, path='./melspecgrams/', mode=None):
+def get_tensors(path='./melspecgrams/', mode=None):
     # Collect data
-    image_tensors = []
-    label_tensors = []
+    image_paths = []
+    label_ids = []
 
     spec_dir = os.path.join(path, mode)
     img_list = [ele for ele in os.listdir(spec_dir) if '.jpg' in ele]
@@ -48,77 +58,228 @@ def get_tensors(transform, path='./melspecgrams/', mode=None):
         song_type = img.split('/')[-1].split("_")[0]
         # print(img, song_type)
         img_path = spec_dir + '/' + img
-        img_tensor = transform(Image.open(img_path).convert('RGB'))
-        image_tensors.append(img_tensor)
-        label_tensors.append(song_types.index(song_type))
+        image_paths.append(img_path)
+        label_ids.append(song_types.index(song_type))
 
-    return image_tensors, label_tensors
+    return image_paths, label_ids
+
+
+class DeviceNormalize(nn.Module):
+    # First layer of the model: scales the uint8 batch to [0, 1] and normalizes it in one pass on the model's device
+    def __init__(self, mean=MEAN, std=STD):
+        super().__init__()
+        self.register_buffer('mean', torch.tensor(mean).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor(std).view(1, 3, 1, 1))
+
+    def forward(self, images):
+        return (images.float() / 255 - self.mean) / self.std
 
 
 class MelSpectrogramDataset(Dataset):
-    def __init__(self, images, labels):
-        self.images = images
+    def __init__(self, paths, labels, transform):
+        self.paths = paths
         self.labels = labels
+        self.transform = transform
 
     def __len__(self):
-        return len(self.images)
+        return len(self.paths)
 
     def __getitem__(self, idx):
         # input, target
-        return self.images[idx], torch.tensor(self.labels[idx], dtype=torch.long)
+        # Images are decoded and transformed on demand so the work is spread over the loader workers
+        image = self.transform(Image.open(self.paths[idx]).convert('RGB'))
+        return image, torch.tensor(self.labels[idx], dtype=torch.long)
+
 
+class EncodedMelSpectrogramDataset(MelSpectrogramDataset):
+    # Yields the raw JPEG bytes; decoding (nvJPEG) and the uint8 tensor transform run on the GPU in decode()
+    def __getitem__(self, idx):
+        return read_file(self.paths[idx]), torch.tensor(self.labels[idx], dtype=torch.long)
+
+    @staticmethod
+    def collate(batch):
+        raw, labels = zip(*batch)
+        return list(raw), torch.stack(labels)
+
+    def decode(self, raw, device):
+        images = decode_jpeg(raw, mode=ImageReadMode.RGB, device=device)
+        return torch.stack([self.transform(image) for image in images])
+
+
+def get_cache_path(path='./melspecgrams/', mode=None, size=(96, 96)):
+    return os.path.join(path, f'{mode}_{size[0]}x{size[1]}.pt')
+
+
+def build_cache(path='./melspecgrams/', mode=None, size=(96, 96)):
+    # Decode and resize a split once, storing it as a single uint8 [N, 3, H, W] tensor next to the images
+    cache_path = get_cache_path(path, mode, size)
+    image_paths, label_ids = get_tensors(path, mode)
+    # The cache is only reused while the split still holds exactly the same, unmodified images
+    files = sorted((os.path.basename(img_path), os.path.getmtime(img_path)) for img_path in image_paths)
+    if os.path.exists(cache_path):
+        try:
+            cached_files = torch.load(cache_path, mmap=True).get('files')
+        except Exception:
+            cached_files = None  # unreadable, e.g. left truncated by an older version
+        if cached_files == files:
+            return cache_path
+        print(f'{cache_path} is out of date, rebuilding it')
+
+    resize = transforms.Resize(size)
+    images = [transforms.functional.pil_to_tensor(resize(Image.open(img_path).convert('RGB')))
+              for img_path in tqdm(image_paths, desc=f'caching {mode} set')]
+    # Written next to the final path and renamed, so an interrupted build never leaves a partial cache behind
+    tmp_path = cache_path + '.tmp'
+    torch.save({'images': torch.stack(images), 'labels': torch.tensor(label_ids, dtype=torch.long), 'files': files},
+               tmp_path)
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+class CachedMelSpectrogramDataset(Dataset):
+    # Serves the uint8 tensors written by build_cache()
+    def __init__(self, cache_path):
+        cache = torch.load(cache_path, mmap=True)
+        self.images = cache['images']
+        self.labels = cache['labels']
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        return self.images[idx], self.labels[idx]
+
+
+def extract_features(backbone, loader, device=DEVICE):
+    backbone = backbone.to(device, memory_format=torch.channels_last).eval()
+    amp_dtype = autocast_dtype(device)
+    features, targets = [], []
+    with torch.no_grad():
+        for batch in tqdm(loader, desc='extracting features'):
+            images, labels = load_batch(loader, batch, device)
+            with torch.cuda.amp.autocast(enabled=device.type == 'cuda', dtype=amp_dtype):
+                features.append(backbone(images).float())
+            targets.append(labels)
+    return TensorDataset(torch.cat(features).cpu(), torch.cat(targets).cpu())
+
+
+def load_batch(loader, batch, device):
+    images, labels = batch
+    if isinstance(loader.dataset, EncodedMelSpectrogramDataset):
+        images = loader.dataset.decode(images, device)
+    else:
+        images = images.to(device, non_blocking=True)
+    if images.dim() == 4:
+        # NHWC maps directly onto cuDNN's tensor-core convolution kernels
+        images = images.contiguous(memory_format=torch.channels_last)
+    return images, labels.to(device, non_blocking=True)
+
+
+def autocast_dtype(device):
+    # BF16 has the exponent range of FP32, so it needs no loss scaling; only Ampere+ (sm_80) runs it natively,
+    # older GPUs would merely emulate it and keep the FP16 + GradScaler path
+    if device.type == 'cuda' and torch.cuda.get_device_capability(device)[0] >= 8:
+        return torch.bfloat16
+    return torch.float16
+
+
+def one_epoch(model, loader, mode, device=DEVICE, epoch_id=None, opt=None, scaler=None, accum_steps=1, amp_dtype=None,
+              no_sync=None):
+    if amp_dtype is None:
+        amp_dtype = autocast_dtype(device)
 
-def one_epoch(model, loader, mode, device=DEVICE, epoch_id=None):
     def run(mode, device=device):
         criterion = nn.CrossEntropyLoss()
-        losses = []
-        correct_preds = 0
+        # Metrics are accumulated on the device and read back once per epoch to avoid a sync per batch
+        total_loss = torch.zeros((), device=device)
+        correct_preds = torch.zeros((), dtype=torch.long, device=device)
         length = 0
-        for batch in tqdm(loader, desc='Epoch '+str(epoch_id+1)+' '+mode):
-            images, labels = batch[0].to(device), batch[1].to(device)
+        num_batches = len(loader)
+        use_scaler = scaler is not None and scaler.is_enabled()
+        if mode == 'train':
+            opt.zero_grad(set_to_none=True)
+        for step, batch in enumerate(tqdm(loader, desc='Epoch '+str(epoch_id+1)+' '+mode)):
+            images, labels = load_batch(loader, batch, device)
             length += images.shape[0]
 
-            outputs = model(images)
+            # Gradients of `accum_steps` consecutive batches are averaged before each optimizer step; the trailing
+            # group of an epoch may be shorter. Under DDP only the last batch of a group all-reduces its gradients,
+            # and no_sync() has to cover the forward pass as well, since that is where DDP prepares the reduction
+            group_size = min(accum_steps, num_batches - step + step % accum_steps)
+            boundary = (step + 1) % accum_steps == 0 or step + 1 == num_batches
+            skip_sync = mode == 'train' and not boundary and no_sync is not None
+            with no_sync() if skip_sync else contextlib.nullcontext():
+                with torch.cuda.amp.autocast(enabled=device.type == 'cuda', dtype=amp_dtype):
+                    outputs = model(images)
+                    loss = criterion(outputs, labels)
+                if mode == 'train':
+                    if use_scaler:
+                        scaler.scale(loss / group_size).backward()
+                    else:
+                        (loss / group_size).backward()
             preds = torch.argmax(outputs, dim=1)
-            loss = criterion(outputs, labels)
 
-            correct_preds += torch.sum(preds == labels).item()
-            losses.append(loss.item())
-
-            if mode == 'train':
-                opt.zero_grad()
-                loss.backward()
-                opt.step()
-        return {'loss': np.mean(losses), 'accuracy': correct_preds / length}
+            correct_preds += torch.sum(preds == labels)
+            total_loss += loss.detach() * images.shape[0]
+
+            if mode == 'train' and boundary:
+                if use_scaler:
+                    scaler.step(opt)
+                    scaler.update()
+                else:
+                    opt.step()
+                opt.zero_grad(set_to_none=True)
+        # Under DDP every rank only sees its shard, so the sums are reduced over all ranks
+        stats = torch.stack([total_loss, correct_preds.to(total_loss.dtype), torch.tensor(float(length), device=device)])
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(stats)
+        total_loss, correct_preds, length = stats.tolist()
+        return {'loss': total_loss / length, 'accuracy': correct_preds / length}
 
     if mode == 'train':
-        opt = optim.SGD(model.parameters(), lr=LR)
         model = model.train()
         return run('train', device)
     else:
         model = model.eval()
-        with torch.no_grad():
+        with torch.inference_mode():
             return run('test', device)
 
 
-def train(train_loader, val_loader, test_loader, model, epochs=EPOCHS, device=DEVICE, writer=None, eval_first=True):
-    model = model.to(device)
+def train(train_loader, val_loader, test_loader, model, epochs=EPOCHS, device=DEVICE, writer=None, eval_first=True,
+          accum_steps=GRAD_ACCUM_STEPS, compile=True):
+    model = model.to(device, memory_format=torch.channels_last)
+    trained_model = model
+    # DDP syncs buffers inside its forward, which would deadlock on the uneven evaluation shards,
+    # so evaluation runs on the wrapped module and only the metric sums are reduced
+    eval_model = model.module if isinstance(model, nn.parallel.DistributedDataParallel) else model
+    # The compiled wrapper does not expose DDP's no_sync(), so it is taken from the DDP module itself
+    no_sync = model.no_sync if isinstance(model, nn.parallel.DistributedDataParallel) else None
+    if compile:
+        # The compiled wrappers share their parameters with `model`, so callers keep using the original module
+        compiled = torch.compile(model, mode='max-autotune')
+        eval_model = compiled if eval_model is model else torch.compile(eval_model, mode='max-autotune')
+        model = compiled
+    amp_dtype = autocast_dtype(device)
     epoch = -1
     if eval_first:
-        evaluate(model, device, val_loader, 'val', epoch)
-        evaluate(model, device, test_loader, 'test', epoch)
+        evaluate(eval_model, device, val_loader, 'val', epoch, amp_dtype)
+        evaluate(eval_model, device, test_loader, 'test', epoch, amp_dtype)
 
     cur_log = log()
+    opt = optim.SGD(model.parameters(), lr=LR, momentum=0.9, nesterov=True)
+    scaler = torch.cuda.amp.GradScaler(enabled=device.type == 'cuda' and amp_dtype == torch.float16)
     for epoch in range(epochs):
-        ret = one_epoch(model, train_loader, 'train', device, epoch)
+        if isinstance(train_loader.sampler, DistributedSampler):
+            train_loader.sampler.set_epoch(epoch)
+        ret = one_epoch(model, train_loader, 'train', device, epoch, opt, scaler, accum_steps, amp_dtype, no_sync)
         train_loss = ret['loss']
         train_acc = ret['accuracy']
         print('Epoch {}: '.format(epoch+1))
         print(f"train loss: {train_loss}")
         print(f"train accuracy: {train_acc}")
 
-        val_loss, val_acc = evaluate(model, device, val_loader, 'val', epoch)
-        test_loss, test_acc = evaluate(model, device, test_loader, 'test', epoch)
+        val_loss, val_acc = evaluate(eval_model, device, val_loader, 'val', epoch, amp_dtype)
+        test_loss, test_acc = evaluate(eval_model, device, test_loader, 'test', epoch, amp_dtype)
         if writer:
             writer.add_scalar('loss/train', train_loss, epoch)
             writer.add_scalar('accuracy/train', train_acc, epoch)
@@ -128,13 +289,12 @@ def train(train_loader, val_loader, test_loader, model, epochs=EPOCHS, device=DE
             writer.add_scalar('accuracy/test', test_acc, epoch)
             
             cur_log.push(train_loss, train_acc, val_loss, val_acc, test_loss, test_acc)
-    model = model.cpu()
-    return cur_log
+    return cur_log, trained_model
 
 
-def evaluate(model, device=DEVICE, loader=None, comment='val', epoch_id=None):
+def evaluate(model, device=DEVICE, loader=None, comment='val', epoch_id=None, amp_dtype=None):
     model = model.to(device)
-    ret = one_epoch(model, loader, 'test', device, epoch_id)
+    ret = one_epoch(model, loader, 'test', device, epoch_id, amp_dtype=amp_dtype)
     loss = ret['loss']
     accuracy = ret['accuracy']
 
@@ -143,50 +303,29 @@ def evaluate(model, device=DEVICE, loader=None, comment='val', epoch_id=None):
     return loss, accuracy
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--dropout', type=float, default=0.5)
-    parser.add_argument('--epochs', type=int, default=EPOCHS)
-    parser.add_argument('--lr', type=float, default=LR)
-    parser.add_argument('--id', type=int, default=-1)
-    parser.add_argument('--metric', type=str, default='weighted')
-    parser.add_argument('--pretrained', action='store_true', default=False)
-    parser.add_argument('--do_train', action='store_true', default=False)
-    parser.add_argument('--data_dir', type=str, default='./melspecgrams/')
-    parser.add_argument('--batch_size', type=int, default=4)
-    parser.add_argument('--network_version', type=str, default='legacy') # "legacy" or "experimental"
-    parser.add_argument('--transforms_version', type=str, default='legacy') # "legacy" or "experimental"
-    args = parser.parse_args()
-    # Parse args
-    print(args)
-    print('Running on:', torch.cuda.get_device_name())
-    LR, EPOCHS = args.lr, args.epochs
-    BATCH_SIZE = args.batch_size
-    DEVICE = torch.device('cuda:0' if args.id >= 0 else 'cpu')
-    
-    # Set backbone of the model
+def build_backbone(backbone_id, pretrained=False):
     backbone = None
-    if args.id == 0:
+    if backbone_id == 0:
         backbone = models.mobilenet_v3_small(pretrained=False)
-        if args.pretrained:
+        if pretrained:
             backbone = models.mobilenet_v3_small(weights="IMAGENET1K_V1")
-    elif args.id == 1:
+    elif backbone_id == 1:
         backbone = models.resnet18(pretrained=False)
-        if args.pretrained:
+        if pretrained:
             backbone = models.resnet18(weights="IMAGENET1K_V1")
-    elif args.id == 2:
+    elif backbone_id == 2:
         backbone = models.vgg16(pretrained=False)
-        if args.pretrained:
+        if pretrained:
             backbone = models.vgg16(weights="IMAGENET1K_V1")
-    elif args.id == 3:
+    elif backbone_id == 3:
         backbone = models.densenet121(pretrained=False)
-        if args.pretrained:
+        if pretrained:
             backbone = models.densenet121(weights="IMAGENET1K_V1")
-    elif args.id == 4:
+    elif backbone_id == 4:
         backbone = models.shufflenet_v2_x1_0(pretrained=False)
-        if args.pretrained:
+        if pretrained:
             backbone = models.shufflenet_v2_x1_0(weights="IMAGENET1K_V1")
-    elif args.id == 5:
+    elif backbone_id == 5:
         from vit_pytorch import ViT
         backbone = ViT(
             image_size = 224,
@@ -199,57 +338,166 @@ if __name__ == '__main__':
             dropout = 0.1,
             emb_dropout = 0.1
         )
-    elif args.id == 6:
+    elif backbone_id == 6:
         backbone = models.vgg19(pretrained=False)
-        if args.pretrained:
+        if pretrained:
             backbone = models.vgg19(weights="IMAGENET1K_V1")
-    elif args.id == 7:
+    elif backbone_id == 7:
         backbone = models.vgg19_bn(pretrained=False)
-        if args.pretrained:
+        if pretrained:
             backbone = models.vgg19_bn(weights="IMAGENET1K_V1")
-    elif args.id == 8:
+    elif backbone_id == 8:
         backbone = models.resnet101(pretrained=False)
-        if args.pretrained:
+        if pretrained:
             backbone = models.resnet101(weights="IMAGENET1K_V1")
-    elif args.id == 9:
+    elif backbone_id == 9:
         backbone = models.resnet50(pretrained=False)
-        if args.pretrained:
+        if pretrained:
             backbone = models.resnet50(weights="IMAGENET1K_V1")
-    elif args.id == 10:
+    elif backbone_id == 10:
         backbone = models.squeezenet1_1(pretrained=False)
-        if args.pretrained:
+        if pretrained:
             backbone = models.squeezenet1_1(weights="IMAGENET1K_V1")
-    elif args.id == 11:
+    elif backbone_id == 11:
         backbone = models.googlenet(pretrained=False)
-        if args.pretrained:
+        if pretrained:
             backbone = models.googlenet(weights="IMAGENET1K_V1")
     else:
         raise KeyError('Current backbone not supported...')
+    return backbone
+
+
+def build_model(backbone, network_version="legacy", dropout=0.5):
+    # Shared with infer.py and vis_emb.py so checkpoints always load into the architecture they were saved from
+    if network_version == "legacy":
+        return nn.Sequential(
+            DeviceNormalize(),
+            backbone,
+            nn.Dropout(p=dropout),
+            nn.Linear(1000, len(song_types))
+        )
+    else:
+        return nn.Sequential(
+            DeviceNormalize(),
+            backbone,
+            nn.ReLU(),
+            nn.BatchNorm1d(1000),
+            nn.Dropout(p = dropout),
+            nn.Linear(1000, len(song_types)),
+        )
+
+
+def make_eval_loader(dataset, rank=0, world_size=1):
+    # Strided, unpadded shards (unlike DistributedSampler) so the reduced metrics count every sample exactly once
+    sampler = range(rank, len(dataset), world_size) if world_size > 1 else None
+    # The val/test splits are small, a couple of workers keep up with them
+    num_workers = min(NUM_WORKERS, EVAL_WORKERS)
+    return DataLoader(dataset, BATCH_SIZE, shuffle=False, sampler=sampler, num_workers=num_workers,
+                      persistent_workers=num_workers > 0, pin_memory=True, collate_fn=getattr(dataset, 'collate', None))
+
+
+def fuse_bn_linear(bn, linear):
+    # Linear(BatchNorm1d(x)) with frozen statistics is a single affine map
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    fused = nn.Linear(linear.in_features, linear.out_features).to(linear.weight.device)
+    with torch.no_grad():
+        fused.weight.copy_(linear.weight * scale)
+        fused.bias.copy_(linear.bias + linear.weight @ shift)
+    return fused
+
+
+def fold_batchnorm(model):
+    # Inference only: folds every BatchNorm1d (-> Dropout) -> Linear of the experimental head into one Linear
+    layers, bn = [], None
+    for layer in model:
+        if isinstance(layer, nn.BatchNorm1d) and bn is None:
+            bn = layer
+            continue
+        if bn is not None and isinstance(layer, nn.Dropout):
+            continue
+        if bn is not None and isinstance(layer, nn.Linear):
+            layer = fuse_bn_linear(bn, layer)
+        elif bn is not None:
+            layers.append(bn)
+        bn = None
+        layers.append(layer)
+    if bn is not None:
+        layers.append(bn)
+    return nn.Sequential(*layers).eval()
+
+
+if __name__ == '__main__':
+    # Inputs are always resized to (96, 96) with a fixed batch size, so the autotuned conv algorithms can be reused
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dropout', type=float, default=0.5)
+    parser.add_argument('--epochs', type=int, default=EPOCHS)
+    parser.add_argument('--lr', type=float, default=LR)
+    parser.add_argument('--id', type=int, default=-1)
+    parser.add_argument('--metric', type=str, default='weighted')
+    parser.add_argument('--pretrained', action='store_true', default=False)
+    parser.add_argument('--do_train', action='store_true', default=False)
+    parser.add_argument('--checkpoint', type=str, default=None) # state dict to evaluate when --do_train is not set
+    parser.add_argument('--data_dir', type=str, default='./melspecgrams/')
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--grad_accum_steps', type=int, default=GRAD_ACCUM_STEPS)
+    parser.add_argument('--num_workers', type=int, default=None) # train loader workers per process, defaults to half the CPUs of the node split over its processes
+    parser.add_argument('--network_version', type=str, default='legacy') # "legacy" or "experimental"
+    parser.add_argument('--transforms_version', type=str, default='legacy') # "legacy" or "experimental"
+    parser.add_argument('--gpu_decode', action='store_true', default=False) # decode JPEGs on the GPU with nvJPEG
+    parser.add_argument('--cache', action='store_true', default=False) # cache the resized uint8 images as .pt files
+    parser.add_argument('--freeze_backbone', action='store_true', default=False) # train the head only, on cached backbone features
+    args = parser.parse_args()
+    # Parse args
+    print(args)
+    print('Running on:', torch.cuda.get_device_name())
+    LR, EPOCHS = args.lr, args.epochs
+    BATCH_SIZE = args.batch_size
+    GRAD_ACCUM_STEPS = args.grad_accum_steps
+    DEVICE = torch.device('cuda:0' if args.id >= 0 else 'cpu')
+
+    # Launched with `torchrun --nproc_per_node=N train.py ...`: one process per GPU
+    WORLD_SIZE = int(os.environ.get('WORLD_SIZE', 1))
+    RANK = int(os.environ.get('RANK', 0))
+    LOCAL_RANK = int(os.environ.get('LOCAL_RANK', 0))
+    LOCAL_WORLD_SIZE = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    # The processes on a node share its CPUs
+    NUM_WORKERS = args.num_workers if args.num_workers is not None else max(1, NUM_WORKERS // LOCAL_WORLD_SIZE)
+    if args.grad_accum_steps < 1:
+        parser.error('--grad_accum_steps must be at least 1')
+    if not args.do_train and args.checkpoint is None:
+        parser.error('either train a model with --do_train or pass the --checkpoint to evaluate')
+    if args.freeze_backbone and not args.pretrained:
+        parser.error('--freeze_backbone requires --pretrained: features of a randomly initialised backbone are meaningless')
+    if args.freeze_backbone and WORLD_SIZE > 1:
+        parser.error('--freeze_backbone only trains a small head and runs in a single process, launch it without torchrun')
+    if WORLD_SIZE > 1:
+        dist.init_process_group('nccl')
+        torch.cuda.set_device(LOCAL_RANK)
+        DEVICE = torch.device('cuda', LOCAL_RANK)
+    
+    # Set backbone of the model
+    backbone = build_backbone(args.id, args.pretrained)
 
     print('backbone pretrained:', args.pretrained)
 
     # Construct the whole model on top of the backbone
-    if args.id != 12:
-        if args.network_version == "legacy":
-            model = nn.Sequential(
-                backbone,
-                nn.Dropout(p=args.dropout),
-                nn.Linear(1000, len(song_types))
-            )
-        else:
-            model = nn.Sequential(
-                backbone,
-                nn.ReLU(),
-                nn.BatchNorm1d(1000),
-                nn.Dropout(p = args.dropout),
-                nn.Linear(1000, len(song_types)),
-            )
+    model = build_model(backbone, args.network_version, args.dropout)
+
+    if WORLD_SIZE > 1:
+        # The memory format has to be final before DDP lays out its gradient buckets
+        model = nn.parallel.DistributedDataParallel(model.to(DEVICE, memory_format=torch.channels_last),
+                                                    device_ids=[LOCAL_RANK])
 
     # Construct the transforms for the dataset
+    # @note They output uint8 tensors, the normalization happens per batch on the device (see DeviceNormalize)
     legacy_transform = transforms.Compose([
             transforms.Resize((96, 96)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+            transforms.PILToTensor()
         ])
     
     if args.transforms_version == "legacy":
@@ -259,47 +507,119 @@ if __name__ == '__main__':
             transforms.Resize((96, 96)),
             transforms.RandomPosterize(2, p = 0.25),
             transforms.ColorJitter(brightness = (0.50, 1.00)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+            transforms.PILToTensor()
+        ])
+
+    if args.gpu_decode:
+        # Tensor equivalents of the transforms above, applied on the device to the decoded uint8 images
+        from torchvision.transforms import v2
+        legacy_transform = v2.Compose([
+            v2.Resize((96, 96), antialias=True)
         ])
+        if args.transforms_version == "legacy":
+            train_transform = legacy_transform
+        else:
+            train_transform = v2.Compose([
+                v2.Resize((96, 96), antialias=True),
+                v2.RandomPosterize(2, p = 0.25),
+                v2.ColorJitter(brightness = (0.50, 1.00))
+            ])
+    dataset_cls = EncodedMelSpectrogramDataset if args.gpu_decode else MelSpectrogramDataset
     
     # Construct the train, test, and val loaders
     # @note We apply the legacy transforms for the test and validation datasets to aid in consistency of metrics' reporting 
-    train_set = MelSpectrogramDataset(*get_tensors(train_transform, args.data_dir, mode='train'))
-    val_set = MelSpectrogramDataset(*get_tensors(legacy_transform, args.data_dir, mode='val'))
-    test_set = MelSpectrogramDataset(*get_tensors(legacy_transform, args.data_dir, mode='test'))
-
-    train_loader = DataLoader(train_set, BATCH_SIZE, shuffle=True)
-    val_loader = DataLoader(val_set, BATCH_SIZE, shuffle=True)
-    test_loader = DataLoader(test_set, BATCH_SIZE, shuffle=True)
+    train_set = dataset_cls(*get_tensors(args.data_dir, mode='train'), train_transform)
+    val_set = dataset_cls(*get_tensors(args.data_dir, mode='val'), legacy_transform)
+    test_set = dataset_cls(*get_tensors(args.data_dir, mode='test'), legacy_transform)
+    if args.cache:
+        # Only splits with a deterministic transform can be cached
+        cached_modes = ['train', 'val', 'test'] if args.transforms_version == "legacy" else ['val', 'test']
+        # Rank 0 alone validates and (re)builds the files, the other ranks only wait for it and load them
+        if RANK == 0:
+            for mode in cached_modes:
+                build_cache(args.data_dir, mode=mode)
+        if WORLD_SIZE > 1:
+            dist.barrier()
+        if 'train' in cached_modes:
+            train_set = CachedMelSpectrogramDataset(get_cache_path(args.data_dir, mode='train'))
+        val_set = CachedMelSpectrogramDataset(get_cache_path(args.data_dir, mode='val'))
+        test_set = CachedMelSpectrogramDataset(get_cache_path(args.data_dir, mode='test'))
+
+    train_sampler = DistributedSampler(train_set) if WORLD_SIZE > 1 else None
+    train_loader = DataLoader(train_set, BATCH_SIZE, shuffle=train_sampler is None, sampler=train_sampler,
+                              num_workers=NUM_WORKERS,
+                              persistent_workers=NUM_WORKERS > 0, prefetch_factor=4 if NUM_WORKERS > 0 else None,
+                              pin_memory=True, collate_fn=getattr(train_set, 'collate', None))
+    val_loader = make_eval_loader(val_set, RANK, WORLD_SIZE)
+    test_loader = make_eval_loader(test_set, RANK, WORLD_SIZE)
 
     print('dataset length:', len(train_set), len(val_set), len(test_set))
     print('dataloader length:', len(train_loader), len(val_loader), len(test_loader))
     
 
     logdir = './logs/' + str(date.today()) + '_' + str(time.time()) + '_' + type(backbone).__name__ + "_LR_" + str(LR) + "EPOCH_" + str(EPOCHS)
-    os.makedirs(logdir, exist_ok=True)
+    if RANK == 0:
+        os.makedirs(logdir, exist_ok=True)
+    model_path = f'{logdir}/finetuned_{type(backbone).__name__}.pt'
     if args.do_train:
-        writer = SummaryWriter(log_dir=logdir)
-        training_log = train(train_loader, val_loader, test_loader, model, EPOCHS, DEVICE, writer)
-        training_log.save(os.path.join(logdir, 'training_log.json'))
-        writer.close()
-        torch.save(model, f'{logdir}/finetuned_{type(backbone).__name__}.pth')
+        writer = SummaryWriter(log_dir=logdir) if RANK == 0 else None
+        if args.freeze_backbone:
+            # The backbone stays fixed, so its features are computed once per split and only the head is trained.
+            # The head shares its layers with `model`, which therefore ends up holding the trained head.
+            feature_extractor, head = model[:2], model[2:]
+            feature_sets = [extract_features(feature_extractor, loader, DEVICE)
+                            for loader in (train_loader, val_loader, test_loader)]
+            train_features = DataLoader(feature_sets[0], BATCH_SIZE, shuffle=True, pin_memory=True)
+            val_features = DataLoader(feature_sets[1], BATCH_SIZE, shuffle=False, pin_memory=True)
+            test_features = DataLoader(feature_sets[2], BATCH_SIZE, shuffle=False, pin_memory=True)
+            # Autotuning a single Linear layer would take longer than the whole head-only training
+            training_log, _ = train(train_features, val_features, test_features, head, EPOCHS, DEVICE, writer,
+                                    accum_steps=GRAD_ACCUM_STEPS, compile=False)
+        else:
+            training_log, model = train(train_loader, val_loader, test_loader, model, EPOCHS, DEVICE, writer,
+                                        accum_steps=GRAD_ACCUM_STEPS)
+        if RANK == 0:
+            training_log.save(os.path.join(logdir, 'training_log.json'))
+            writer.close()
+            net = model.module if isinstance(model, nn.parallel.DistributedDataParallel) else model
+            torch.save(net.state_dict(), model_path)
+
+    # Only the first process reports the final metrics
+    if WORLD_SIZE > 1:
+        dist.destroy_process_group()
+        if RANK != 0:
+            sys.exit(0)
+    if isinstance(model, nn.parallel.DistributedDataParallel):
+        model = model.module
+        # The final report covers the whole val/test sets; the sharded loaders go first so their
+        # persistent workers are shut down before the new pools start
+        del train_loader, val_loader, test_loader
+        val_loader, test_loader = make_eval_loader(val_set), make_eval_loader(test_set)
     
+    # The freshly trained weights are already in `model` on the device; only load them when training was skipped
+    if not args.do_train:
+        model.load_state_dict(torch.load(args.checkpoint, map_location=DEVICE))
+    model = model.to(DEVICE, memory_format=torch.channels_last).eval()
+    eval_model = fold_batchnorm(model) if args.network_version != "legacy" else model
+    amp_dtype = autocast_dtype(DEVICE)
+
     for mode in ['val', 'test']:
         print(f"{mode}:")
-        model = torch.load(f'{logdir}/finetuned_{type(backbone).__name__}.pth')
-        y_test, y_pred = [], []
-        model = model.to(DEVICE)
-        for images, labels in tqdm(test_loader if mode == 'test' else val_loader):
-            images, labels = images.to(DEVICE), labels.to(DEVICE)
-            outputs = model(images)
-            preds = torch.argmax(outputs, dim=1)
-
-            y_test += labels.cpu().numpy().tolist()
-            y_pred += preds.cpu().numpy().tolist()
-
-        model = model.cpu()
+        y_list, p_list = [], []
+        loader = test_loader if mode == 'test' else val_loader
+        with torch.inference_mode():
+            for batch in tqdm(loader):
+                images, labels = load_batch(loader, batch, DEVICE)
+                # Same precision as the per-epoch evaluation in one_epoch
+                with torch.cuda.amp.autocast(enabled=DEVICE.type == 'cuda', dtype=amp_dtype):
+                    outputs = eval_model(images)
+                preds = torch.argmax(outputs, dim=1)
+
+                # Kept on the device and copied back once after the loop
+                y_list.append(labels)
+                p_list.append(preds)
+        y_test = torch.cat(y_list).cpu().numpy()
+        y_pred = torch.cat(p_list).cpu().numpy()
 
         cm = confusion_matrix(y_test, y_pred)
         _ = ConfusionMatrixDisplay(cm, display_labels=('FH', 'BH', 'PH', 'MH')).plot()
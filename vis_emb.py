@@ -2,7 +2,7 @@ import csv
 import torch
 from torch import nn
 from torchvision import models
-from train import train_loader, val_loader, test_loader
+from train import train_loader, val_loader, test_loader, build_backbone, build_model
 from tqdm import tqdm
 import numpy as np
 from tensorboard import summary
@@ -14,7 +14,10 @@ sns.set()
 song_types = ['future house', 'bass house', 'progressive house', 'melodic house']
 colors = ['darkred', 'darkorange', 'darkblue', 'darkgreen']
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-ft_model = torch.load('./param/finetuned_ResNet.pth').to(device)
+# ResNet18 backbone with the legacy head, as built by train.py
+ft_model = build_model(build_backbone(1))
+ft_model.load_state_dict(torch.load('./param/finetuned_ResNet.pt', map_location=device))
+ft_model = ft_model.to(device)
 
 
 """